@@ -7,9 +7,10 @@
 
 import re
 import os
+import mmap
 import stat
 import shutil
-from pathlib import Path
+import tempfile
 from typing import Dict, List, Optional, Tuple
 from enum import Enum
 
@@ -24,6 +25,45 @@ except ImportError:
     def get_text(key, **kwargs):
         return key
 
+# 平台相关的写权限位在导入时确定一次，避免每次检查重复判断平台
+_WRITE_FLAG = stat.S_IWRITE if os.name == 'nt' else stat.S_IWUSR
+
+# 模块加载时预编译callApi匹配正则，避免每次调用重新编译
+_CALLAPI_RE = re.compile(r'async\s+callApi\s*\([^)]*\)\s*\{')
+# 字节版本，用于在mmap缓冲区上定位callApi
+_CALLAPI_BYTES_RE = re.compile(rb'async\s+callApi\s*\([^)]*\)\s*\{')
+
+# 补丁签名，用于检测是否已补丁
+_PATCH_SIGNATURES = (
+    'startsWith("report-")',
+    'startsWith("record-")',
+    'randSessionId',
+    'this._userAgent = ""',
+)
+# 签名合并为单个交替正则，模块加载时编译一次，检测只需一遍自动机扫描
+_PATCH_SIG_RE = re.compile('|'.join(re.escape(sig) for sig in _PATCH_SIGNATURES))
+# 字节版本，可直接在mmap缓冲区上搜索，无需解码文件内容
+_PATCH_SIG_BYTES_RE = re.compile(
+    b'|'.join(re.escape(sig.encode('utf-8')) for sig in _PATCH_SIGNATURES))
+
+# 合并签名与callApi的单遍扫描正则：一次自动机扫描同时得到
+# "是否已补丁"和callApi注入点，命名分组区分命中的是哪一类
+_SCAN_BYTES_RE = re.compile(
+    b'(?P<sig>' + b'|'.join(re.escape(sig.encode('utf-8')) for sig in _PATCH_SIGNATURES) +
+    b')|(?P<call>' + _CALLAPI_BYTES_RE.pattern + b')')
+
+# 扫描缓存条目上限，限制GUI反复刷新多个IDE状态时的内存占用
+_STATUS_CACHE_MAX = 64
+
+# 签名探测窗口：补丁总是注入在callApi函数体开头，签名只会出现在
+# 注入点之后的这段范围内，远小于整个bundle
+_SIG_PROBE_LEN = 4096
+
+# 流式扫描的块大小与跨块重叠字节数。重叠需覆盖最长签名和
+# callApi函数头，保证匹配落在块边界上时不被漏掉
+_SCAN_CHUNK_SIZE = 1024 * 1024
+_SCAN_OVERLAP = 4096
+
 
 class PatchMode(Enum):
     """补丁模式枚举"""
@@ -46,7 +86,11 @@ class PatchResult:
 class PatchManager:
     """代码补丁管理器"""
     
-    def __init__(self):
+    def __init__(self, full_scan: bool = False):
+        # full_scan=True时签名检测扫描整个文件而不只是注入点附近的窗口，
+        # 供恢复等需要绝对保守判断的流程使用
+        self.full_scan = full_scan
+
         # 补丁代码模板
         self.patches = {
             PatchMode.BLOCK: 'if (typeof s === "string" && (s.startsWith("report-") || s.startsWith("record-"))) { return { success: true }; }',
@@ -60,13 +104,22 @@ class PatchManager:
             PatchMode.DEBUG: 'if (typeof s === "string" && (s.startsWith("report-") || s.startsWith("record-"))) { i = { timestamp: Date.now(), version: Math.random().toString(36).substring(2, 8) }; } if (typeof s === "string" && s === "subscription-info") { return { success: true, subscription: { Enterprise: {}, ActiveSubscription: { end_date: "2026-12-31", usage_balance_depleted: false } } }; } this.maxUploadSizeBytes = 999999999; this.maxTrackableFileCount = 999999; this.completionTimeoutMs = 999999; this.diffBudget = 999999; this.messageBudget = 999999; this.enableDebugFeatures = true;'
         }
         
-        # 补丁签名，用于检测是否已补丁
-        self.patch_signatures = [
-            'startsWith("report-")',
-            'startsWith("record-")', 
-            'randSessionId',
-            'this._userAgent = ""'
-        ]
+        # 完整补丁载荷在构造时拼接一次，热路径上只做字典查找
+        randomizer = self._generate_session_randomizer()
+        self.final_patches: Dict[PatchMode, str] = {
+            mode: patch + randomizer for mode, patch in self.patches.items()
+        }
+        # 预编码的字节版本，供字节级写入路径使用
+        self.final_patches_bytes: Dict[PatchMode, bytes] = {
+            mode: patch.encode('utf-8') for mode, patch in self.final_patches.items()
+        }
+
+        # 补丁签名(模块级常量的实例引用，保持既有属性接口)
+        self.patch_signatures = list(_PATCH_SIGNATURES)
+
+        # 扫描结果缓存: realpath -> (mtime_ns, size, 是否已补丁, callApi字节区间)
+        # 避免get_patch_status之后紧跟apply_patch时重复扫描整个文件
+        self._status_cache: Dict[str, Tuple[int, int, bool, Optional[Tuple[int, int]]]] = {}
     
     def get_patch_description(self, mode: PatchMode) -> str:
         """获取补丁模式描述"""
@@ -83,16 +136,16 @@ class PatchManager:
         """生成会话随机化代码"""
         return ' const chars = "0123456789abcdef"; let randSessionId = ""; for (let i = 0; i < 36; i++) { randSessionId += i === 8 || i === 13 || i === 18 || i === 23 ? "-" : i === 14 ? "4" : i === 19 ? chars[8 + Math.floor(4 * Math.random())] : chars[Math.floor(16 * Math.random())]; } this.sessionId = randSessionId; this._userAgent = "";'
 
-    def _check_file_readonly(self, file_path: str) -> bool:
-        """检查文件是否为只读状态"""
-        try:
-            file_path_obj = Path(file_path)
-            if not file_path_obj.exists():
-                return False
+    def _check_file_readonly(self, file_path: str, st: Optional[os.stat_result] = None) -> bool:
+        """检查文件是否为只读状态
 
-            file_stat = file_path_obj.stat()
+        调用方已持有os.stat结果时可直接传入，避免重复的stat系统调用。
+        """
+        try:
+            if st is None:
+                st = os.stat(file_path)
             # 检查用户是否有写权限
-            return not (file_stat.st_mode & stat.S_IWUSR)
+            return not (st.st_mode & _WRITE_FLAG)
         except Exception:
             return False
 
@@ -120,111 +173,208 @@ class PatchManager:
             else:
                 return f"文件写入失败：{original_error}\n请检查文件是否被其他程序占用或权限设置"
     
+    @staticmethod
+    def _backup_path(file_path: str) -> str:
+        """生成备份文件路径(xxx.js -> xxx_ori.js)"""
+        stem, suffix = os.path.splitext(file_path)
+        return f'{stem}_ori{suffix}'
+
     def _create_backup(self, file_path: str) -> Tuple[bool, str]:
         """创建文件备份"""
         try:
-            file_path_obj = Path(file_path)
-            # 正确生成备份文件名
-            backup_path = file_path_obj.with_name(f'{file_path_obj.stem}_ori{file_path_obj.suffix}')
-            
-            if backup_path.exists():
+            backup_path = self._backup_path(file_path)
+
+            if os.path.exists(backup_path):
                 print_warning(f"备份文件已存在: {backup_path}")
-                return True, str(backup_path)
-            
-            shutil.copy2(file_path, backup_path)
+                return True, backup_path
+
+            # 补丁写入走"临时文件+os.replace"，原inode不会被原地改写，
+            # 因此硬链接即可充当零拷贝备份；不支持硬链接的文件系统
+            # (或Windows上权限不足时)回退到完整拷贝
+            try:
+                os.link(file_path, backup_path)
+            except OSError:
+                shutil.copy2(file_path, backup_path)
             print_success(f"备份创建成功: {backup_path}")
-            return True, str(backup_path)
-            
+            return True, backup_path
+
         except Exception as e:
             print_error(f"创建备份失败: {e}")
             return False, ""
     
-    def _is_already_patched(self, content: str) -> bool:
-        """检查文件是否已被补丁"""
-        return any(sig in content for sig in self.patch_signatures)
+    def _is_already_patched(self, content: str, probe_start: int = 0,
+                            probe_len: Optional[int] = None) -> bool:
+        """检查内容是否已被补丁，可选地只探测指定窗口"""
+        if probe_len is None:
+            return _PATCH_SIG_RE.search(content, probe_start) is not None
+        return _PATCH_SIG_RE.search(content, probe_start, probe_start + probe_len) is not None
+
+    def _scan_file(self, file_path: str) -> Tuple[bool, Optional[Tuple[int, int]]]:
+        """扫描文件的补丁状态和callApi位置(字节偏移)
+
+        结果按(mtime_ns, size)缓存，文件未变化时直接复用，
+        避免状态查询和补丁操作各自重新扫描整个文件。
+        缓存按LRU方式维护，条目数以_STATUS_CACHE_MAX为上限。
+        """
+        real_path = os.path.realpath(file_path)
+        st = os.stat(file_path)
+        cached = self._status_cache.get(real_path)
+        if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            # 命中后移到末尾，保持LRU淘汰顺序
+            self._status_cache[real_path] = self._status_cache.pop(real_path)
+            return cached[2], cached[3]
+
+        patched, span = self._scan_stream(file_path)
+
+        if real_path not in self._status_cache and len(self._status_cache) >= _STATUS_CACHE_MAX:
+            # 淘汰最久未使用的条目
+            self._status_cache.pop(next(iter(self._status_cache)))
+        self._status_cache[real_path] = (st.st_mtime_ns, st.st_size, patched, span)
+        return patched, span
+
+    def _scan_stream(self, file_path: str) -> Tuple[bool, Optional[Tuple[int, int]]]:
+        """分块流式扫描文件，返回(是否已补丁, callApi字节区间)
+
+        每次只驻留一个固定大小的块(外加跨块重叠)，内存峰值与文件
+        大小无关。签名与callApi通过_SCAN_BYTES_RE的命名分组在同一遍
+        自动机扫描中识别，得到所需结果后立即返回。
+        """
+        span: Optional[Tuple[int, int]] = None
+        saw_sig = False
+        with open(file_path, 'rb') as f:
+            tail = b''
+            base = 0  # tail在文件中的起始偏移
+            while True:
+                chunk = f.read(_SCAN_CHUNK_SIZE)
+                if not chunk:
+                    break
+                buf = tail + chunk
+                for match in _SCAN_BYTES_RE.finditer(buf):
+                    if match.lastgroup == 'call':
+                        if span is None:
+                            span = (base + match.start(), base + match.end())
+                        continue
+                    # 命中签名
+                    if self.full_scan:
+                        saw_sig = True
+                        if span is not None:
+                            return True, span
+                    elif span is not None:
+                        # 注入点已定位：只认探测窗口内的签名
+                        if base + match.start() <= span[1] + _SIG_PROBE_LEN:
+                            return True, span
+                    else:
+                        saw_sig = True
+                if span is not None and not self.full_scan \
+                        and base + len(buf) >= span[1] + _SIG_PROBE_LEN:
+                    # 探测窗口已全部扫过且无签名命中
+                    return False, span
+                tail = buf[-_SCAN_OVERLAP:]
+                base += len(buf) - len(tail)
+        if span is not None and not self.full_scan:
+            return False, span
+        return saw_sig, span
+
+    def _invalidate_status_cache(self, file_path: str) -> None:
+        """文件被改写后清除对应的扫描缓存"""
+        self._status_cache.pop(os.path.realpath(file_path), None)
     
     def _find_callapi_function(self, content: str) -> Optional[re.Match]:
         """查找async callApi函数"""
-        pattern = r'(async\s+callApi\s*\([^)]*\)\s*\{)'
-        return re.search(pattern, content)
+        return _CALLAPI_RE.search(content)
     
+    def _write_patched(self, file_path: str, insert_at: int, patch_bytes: bytes) -> None:
+        """按字节拼接写入同目录临时文件，再原子替换原文件
+
+        原文件、补丁、剩余内容分三次write写入，避免在内存中拼出
+        完整副本；os.replace保证失败时原文件保持原样，无需恢复流程。
+        """
+        st = os.stat(file_path)
+        fd = os.open(file_path, os.O_RDONLY)
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(file_path)),
+                                          delete=False)
+        try:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                tmp.write(mm[:insert_at])
+                tmp.write(patch_bytes)
+                tmp.write(mm[insert_at:])
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            tmp.close()
+            os.chmod(tmp.name, stat.S_IMODE(st.st_mode))
+            os.replace(tmp.name, file_path)
+        except Exception:
+            tmp.close()
+            try:
+                os.unlink(tmp.name)
+            except OSError:
+                pass
+            raise
+        finally:
+            os.close(fd)
+
     def apply_patch(self, file_path: str, patch_mode: PatchMode) -> PatchResult:
         """应用补丁到指定文件"""
         try:
-            # 检查文件是否存在
-            if not os.path.exists(file_path):
+            # 走扫描缓存检查补丁状态并定位callApi函数
+            # 文件是否存在由_scan_file内的os.stat一并判断，省掉一次exists系统调用
+            try:
+                already_patched, span = self._scan_file(file_path)
+            except FileNotFoundError:
                 return PatchResult(False, f"文件不存在: {file_path}")
-            
+
             print_info(f"开始补丁文件: {file_path}")
             print_info(f"补丁模式: {patch_mode.value} - {self.get_patch_description(patch_mode)}")
-            
-            # 读取文件内容
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-            except Exception as e:
-                return PatchResult(False, f"读取文件失败: {e}")
-            
-            # 检查是否已被补丁
-            if self._is_already_patched(content):
+
+            if already_patched:
                 return PatchResult(False, "文件已被补丁，跳过操作")
-            
-            # 查找callApi函数
-            match = self._find_callapi_function(content)
-            if not match:
+
+            if span is None:
                 return PatchResult(False, "未找到async callApi函数")
-            
+
             # 创建备份
             backup_success, backup_path = self._create_backup(file_path)
             if not backup_success:
                 return PatchResult(False, "创建备份失败")
-            
-            # 生成完整补丁代码
-            patch_code = self.patches[patch_mode] + self._generate_session_randomizer()
-            
-            # 应用补丁
-            func_start = match.end()
-            patched_content = content[:func_start] + patch_code + content[func_start:]
-            
+
             # 写入补丁后的内容
             try:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(patched_content)
-                
+                self._write_patched(file_path, span[1], self.final_patches_bytes[patch_mode])
+
+                self._invalidate_status_cache(file_path)
                 print_success(f"补丁应用成功: {file_path}")
                 print_info(f"效果: {self.get_patch_description(patch_mode)}")
                 print_info("隐私保护已启用!")
-                
+
                 return PatchResult(True, "补丁应用成功", file_path, backup_path)
-                
+
             except Exception as e:
-                # 尝试从备份恢复
-                try:
-                    shutil.copy2(backup_path, file_path)
-                    print_warning("已从备份恢复原始文件")
-                except:
-                    print_error("恢复原始文件失败!")
-
-                # 生成详细的错误信息
+                # 原子替换失败时原文件未被改动，直接报告错误即可
                 error_message = self._get_permission_error_message(file_path, str(e))
                 return PatchResult(False, error_message)
-                
+
         except Exception as e:
             return PatchResult(False, f"补丁操作失败: {e}")
     
     def restore_from_backup(self, file_path: str) -> PatchResult:
         """从备份恢复原始文件"""
         try:
-            file_path_obj = Path(file_path)
-            backup_path = file_path_obj.with_name(f'{file_path_obj.stem}_ori{file_path_obj.suffix}')
+            backup_path = self._backup_path(file_path)
 
-            if not backup_path.exists():
+            if not os.path.exists(backup_path):
                 return PatchResult(False, f"备份文件不存在: {backup_path}")
 
+            # 硬链接备份创建后若补丁未实际写入，备份与原文件仍共享inode，
+            # 此时文件本身就是原始内容，直接拷贝反而会把两者一起截断
+            if os.path.exists(file_path) and os.path.samefile(backup_path, file_path):
+                print_success(f"文件未被修改，无需恢复: {file_path}")
+                return PatchResult(True, "恢复成功", file_path, backup_path)
+
             shutil.copy2(backup_path, file_path)
+            self._invalidate_status_cache(file_path)
             print_success(f"已从备份恢复: {file_path}")
 
-            return PatchResult(True, "恢复成功", file_path, str(backup_path))
+            return PatchResult(True, "恢复成功", file_path, backup_path)
 
         except Exception as e:
             # 生成详细的错误信息
@@ -234,13 +384,12 @@ class PatchManager:
     def get_patch_status(self, file_path: str) -> str:
         """获取文件的补丁状态"""
         try:
-            if not os.path.exists(file_path):
+            try:
+                already_patched, _ = self._scan_file(file_path)
+            except FileNotFoundError:
                 return get_text("patch.status.file_not_found") if LANGUAGE_SUPPORT else "文件不存在"
 
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-
-            if self._is_already_patched(content):
+            if already_patched:
                 return get_text("patch.status.patched") if LANGUAGE_SUPPORT else "已补丁"
             else:
                 return get_text("patch.status.not_patched") if LANGUAGE_SUPPORT else "未补丁"